@@ -0,0 +1,53 @@
+"""Create the videos and jobs tables
+
+Revision ID: 0000
+Revises:
+Create Date: 2026-10-14
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+revision = "0000"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Schema as first shipped; later revisions add the foreign-key indexes and stream columns.
+    # Databases whose tables were already created by Base.metadata.create_all are left as they are;
+    # offline (--sql) there is no database to inspect, so the script creates both
+    tables = [] if context.is_offline_mode() else sa.inspect(op.get_bind()).get_table_names()
+    if "videos" not in tables:
+        op.create_table(
+            "videos",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("filename", sa.String()),
+            sa.Column("original_filename", sa.String()),
+            sa.Column("duration", sa.Float()),
+            sa.Column("size", sa.Integer()),
+            sa.Column("upload_time", sa.DateTime()),
+            sa.Column("path", sa.String()),
+            sa.Column("is_processed", sa.Boolean()),
+            sa.Column("quality", sa.String()),
+            sa.Column("parent_id", sa.Integer(), sa.ForeignKey("videos.id"), nullable=True),
+        )
+        op.create_index("ix_videos_id", "videos", ["id"])
+        op.create_index("ix_videos_filename", "videos", ["filename"])
+    if "jobs" not in tables:
+        op.create_table(
+            "jobs",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("job_id", sa.String()),
+            sa.Column("video_id", sa.Integer(), sa.ForeignKey("videos.id")),
+            sa.Column("type", sa.String()),
+            sa.Column("status", sa.String()),
+            sa.Column("created_at", sa.DateTime()),
+            sa.Column("completed_at", sa.DateTime(), nullable=True),
+            sa.Column("parameters", sa.JSON()),
+        )
+        op.create_index("ix_jobs_id", "jobs", ["id"])
+        op.create_index("ix_jobs_job_id", "jobs", ["job_id"], unique=True)
+
+def downgrade():
+    op.drop_table("jobs")
+    op.drop_table("videos")
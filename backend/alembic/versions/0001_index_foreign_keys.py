@@ -0,0 +1,33 @@
+"""Index jobs.video_id and videos.parent_id
+
+Revision ID: 0001
+Revises: 0000
+Create Date: 2026-10-14
+"""
+from alembic import op
+
+revision = "0001"
+down_revision = "0000"
+branch_labels = None
+depends_on = None
+
+# (index name, table, column); names match what Base.metadata.create_all generates for index=True
+INDEXES = [
+    ("ix_jobs_video_id", "jobs", "video_id"),
+    ("ix_videos_parent_id", "videos", "parent_id"),
+]
+
+def upgrade():
+    # IF NOT EXISTS keeps this safe on databases whose tables were created after the indexes were declared
+    if op.get_context().dialect.name == "postgresql":
+        # CONCURRENTLY avoids locking the tables for writes, but cannot run inside a transaction
+        with op.get_context().autocommit_block():
+            for name, table, column in INDEXES:
+                op.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({column})")
+    else:
+        for name, table, column in INDEXES:
+            op.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({column})")
+
+def downgrade():
+    for name, _, _ in INDEXES:
+        op.execute(f"DROP INDEX IF EXISTS {name}")
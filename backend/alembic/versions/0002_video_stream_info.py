@@ -0,0 +1,36 @@
+"""Store width, height and video codec on videos
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-14
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+COLUMNS = [
+    ("width", sa.Integer()),
+    ("height", sa.Integer()),
+    ("video_codec", sa.String()),
+]
+
+def upgrade():
+    # Nullable, so existing rows need no backfill; they get values when next probed. Columns already
+    # present (tables created by Base.metadata.create_all after they were declared) are skipped;
+    # offline (--sql) there is no database to inspect, so the script adds all of them
+    if context.is_offline_mode():
+        existing = set()
+    else:
+        existing = {column["name"] for column in sa.inspect(op.get_bind()).get_columns("videos")}
+    for name, type_ in COLUMNS:
+        if name not in existing:
+            op.add_column("videos", sa.Column(name, type_, nullable=True))
+
+def downgrade():
+    with op.batch_alter_table("videos") as batch_op:
+        for name, _ in COLUMNS:
+            batch_op.drop_column(name)
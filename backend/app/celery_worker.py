@@ -1,10 +1,21 @@
+import os
+
+# Inherited by the ffmpeg processes the tasks spawn; each one opens its own CUDA context
+os.environ.setdefault("CUDA_DEVICE_MAX_CONNECTIONS", "2")
+
 from celery import Celery
+from celery.signals import worker_init, worker_process_init
+from sqlalchemy.exc import OperationalError
 from .database import SessionLocal
 from . import crud, video_processor
-import os
 from pathlib import Path
-import uuid
-from .config import REDIS_URL
+import itertools
+import time
+import inspect
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from .config import REDIS_URL, VIDEOS_DIR, SCRATCH_DIR, CELERY_PREFETCH_MULTIPLIER, CELERY_MAX_TASKS_PER_CHILD, USE_HWACCEL, HWACCEL_DEVICE, FFMPEG_THREADS
 
 # Celery configuration
 celery_app = Celery(
@@ -13,210 +24,357 @@ celery_app = Celery(
     backend=REDIS_URL
 )
 
-@celery_app.task
-def process_video_upload(file_path, original_filename, video_id, job_id):
-    """Process video upload - calculate duration and size"""
-    db = SessionLocal()
+# Video tasks run for tens of seconds to minutes: reserve only one task per process so idle
+# workers can pick up queued jobs, and acknowledge after completion so a crashed worker's job is redelivered
+celery_app.conf.update(
+    worker_prefetch_multiplier=CELERY_PREFETCH_MULTIPLIER,
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    worker_max_tasks_per_child=CELERY_MAX_TASKS_PER_CHILD,
+    # Keep retrying if Redis is not up yet when the worker starts (and silence Celery 5.3's deprecation warning)
+    broker_connection_retry_on_startup=True,
+    hwaccel=None
+)
+
+# With a fixed per-encode thread count, run only as many encodes as there are cores for them
+if FFMPEG_THREADS:
+    celery_app.conf.worker_concurrency = max(1, (os.cpu_count() or 1) // FFMPEG_THREADS)
+
+# Encoding tasks go to the "gpu" queue, served by a --pool=threads worker whose concurrency matches the
+# GPU's NVENC capacity; metadata probes and stream-copy trims never touch the GPU and run on "cpu"
+celery_app.conf.task_routes = {
+    "app.celery_worker.process_video_upload": {"queue": "cpu"},
+    "app.celery_worker.process_video_trim": {"queue": "cpu"},
+    "app.celery_worker.process_quality_change": {"queue": "gpu"},
+    "app.celery_worker.process_quality_batch": {"queue": "gpu"},
+    "app.celery_worker.process_b_roll_overlay": {"queue": "gpu"},
+    "app.celery_worker.process_image_overlay": {"queue": "gpu"},
+    "app.celery_worker.process_compose_overlays": {"queue": "gpu"},
+    "app.celery_worker.process_watermark": {"queue": "gpu"}
+}
+
+# Output-name sequence: process ID plus a millisecond-seeded counter is unique without reading /dev/urandom
+_SEQ = itertools.count(int(time.time() * 1000))
+
+# Output filename templates, filled with format_map
+TRIM_TEMPLATE = "trimmed_{id}_{tok}.mp4"
+QUALITY_TEMPLATE = "{q}_{id}_{tok}.mp4"
+
+def _output_token():
+    """Short unique token for output filenames"""
+    return f"{os.getpid():x}{next(_SEQ):x}"
+
+def _in_background(func, *args, **kwargs):
+    """Start a blocking, read-only video_processor call on a helper thread and return its Future"""
+    # One short-lived thread per call, so tasks running in a threads pool never wait on each other's helpers
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="video_processor")
+    future = executor.submit(func, *args, **kwargs)
+    executor.shutdown(wait=False)
+    return future
+
+def _publish(outputs, render, *args, **kwargs):
+    """Run a render into scratch space, probe each output and move it into place"""
+    # outputs maps scratch path -> final path; returns {final path: probe_video metadata}.
+    # shutil.move renames within one filesystem and copies across them (tmpfs -> disk)
     try:
+        render(*args, **kwargs)
+        metadata = {}
+        for scratch_path, output_path in outputs.items():
+            metadata[output_path] = video_processor.probe_video(scratch_path)
+            shutil.move(scratch_path, output_path)
+        return metadata
+    finally:
+        # Don't leave partial outputs behind in (memory-backed) scratch space on failure
+        for scratch_path in outputs:
+            if os.path.exists(scratch_path):
+                os.remove(scratch_path)
+
+@worker_process_init.connect
+def reseed_output_sequence(**kwargs):
+    """Restart the sequence in each pool process so a recycled child never reuses an earlier one's names"""
+    global _SEQ
+    _SEQ = itertools.count(int(time.time() * 1000))
+
+class VideoTask(celery_app.Task):
+    """Base for processing tasks: retries transient ffmpeg/database errors, then marks the job failed"""
+    autoretry_for = (subprocess.CalledProcessError, OperationalError)
+    retry_backoff = 2
+    retry_jitter = True
+    max_retries = 3
+    
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        """Record the error on the task's job(s) once retries are exhausted or the error is not retryable"""
+        arguments = inspect.signature(self.run).bind(*args, **kwargs).arguments
+        job_ids = arguments.get("job_ids") or [arguments["job_id"]]
+        db = SessionLocal()
+        try:
+            for job_id in job_ids:
+                crud.update_job_status(db, job_id, "failed", {"error": str(exc)})
+        finally:
+            db.close()
+
+@worker_init.connect
+def probe_hwaccel(**kwargs):
+    """Probe NVENC once when the worker starts; pool processes inherit the cached result"""
+    if USE_HWACCEL and video_processor.nvenc_available(HWACCEL_DEVICE):
+        celery_app.conf.hwaccel = HWACCEL_DEVICE
+
+# Tasks hold a database session only around their reads and writes: ffmpeg and ffprobe run with no
+# connection checked out, so a small pool can serve many concurrent workers. Renders start only once
+# "processing" is committed, so a failed commit (and its retry) never leaves an encode running
+@celery_app.task(base=VideoTask, bind=True)
+def process_video_upload(self, file_path, original_filename, video_id, job_id):
+    """Process video upload - read duration, size, dimensions and codec from the container header"""
+    # Probe while the "processing" status is committed
+    probing = _in_background(video_processor.probe_video, file_path)
+    with SessionLocal() as db:
         crud.update_job_status(db, job_id, "processing")
-        duration = video_processor.get_video_duration(file_path)
-        size = video_processor.get_video_size(file_path)
-        
+    metadata = probing.result()
+    
+    with SessionLocal() as db:
         # Update video record with metadata
-        crud.update_video_metadata(db, video_id, duration, size)
+        crud.update_video_metadata(db, video_id, **metadata, commit=False)
         
-        # Mark job as completed
-        crud.update_job_status(db, job_id, "completed")
-    except Exception as e:
-        crud.update_job_status(db, job_id, "failed", {"error": str(e)})
-    finally:
-        db.close()
+        # Mark job as completed in the same transaction
+        crud.update_job_status(db, job_id, "completed", commit=False)
+        db.commit()
 
-@celery_app.task
-def process_video_trim(video_id, start_time, end_time, job_id):
+@celery_app.task(base=VideoTask, bind=True)
+def process_video_trim(self, video_id, start_time, end_time, job_id, accurate=False):
     """Process video trimming"""
-    db = SessionLocal()
-    try:
-        crud.update_job_status(db, job_id, "processing")
+    with SessionLocal() as db:
         # Get original video
         video = crud.get_video(db, video_id)
         
         # Create output path
-        output_filename = f"trimmed_{video.id}_{uuid.uuid4().hex}.mp4"
-        output_path = os.path.join("static", "videos", output_filename)
-        
-        # Trim video
-        video_processor.trim_video(video.path, output_path, start_time, end_time)
-        
+        output_filename = TRIM_TEMPLATE.format_map({"id": video.id, "tok": _output_token()})
+        output_path = str(VIDEOS_DIR / output_filename)
+        scratch_path = str(SCRATCH_DIR / output_filename)
+        crud.update_job_status(db, job_id, "processing")
+    
+    # Trim video into scratch space
+    metadata = _publish(
+        {scratch_path: output_path},
+        video_processor.trim_video, video.path, scratch_path, start_time, end_time, accurate
+    )[output_path]
+    
+    with SessionLocal() as db:
         # Create new video record for trimmed version
-        duration = video_processor.get_video_duration(output_path)
-        size = video_processor.get_video_size(output_path)
-        
         new_video = crud.create_video(
             db, 
+            commit=False,
             filename=output_filename,
             original_filename=f"trimmed_{video.original_filename}",
-            duration=duration,
-            size=size,
+            **metadata,
             path=output_path,
             parent_id=video.id,
             quality=video.quality
         )
         
-        # Update job status
-        crud.update_job_status(db, job_id, "completed", {"new_video_id": new_video.id})
-    except Exception as e:
-        crud.update_job_status(db, job_id, "failed", {"error": str(e)})
-    finally:
-        db.close()
+        # Update job status and commit it together with the new video record
+        crud.update_job_status(db, job_id, "completed", {"new_video_id": new_video.id}, commit=False)
+        db.commit()
 
-@celery_app.task
-def process_quality_change(video_id, quality, job_id):
+@celery_app.task(base=VideoTask, bind=True)
+def process_quality_change(self, video_id, quality, job_id):
     """Process quality change"""
-    db = SessionLocal()
-    try:
-        crud.update_job_status(db, job_id, "processing")
+    with SessionLocal() as db:
         # Get original video
         video = crud.get_video(db, video_id)
         
         # Create output path
-        output_filename = f"{quality}_{video.id}_{uuid.uuid4().hex}.mp4"
-        output_path = os.path.join("static", "videos", output_filename)
-        
-        # Change quality
-        video_processor.change_quality(video.path, output_path, quality)
-        
+        output_filename = QUALITY_TEMPLATE.format_map({"q": quality, "id": video.id, "tok": _output_token()})
+        output_path = str(VIDEOS_DIR / output_filename)
+        scratch_path = str(SCRATCH_DIR / output_filename)
+        crud.update_job_status(db, job_id, "processing")
+    
+    # Change quality into scratch space
+    metadata = _publish(
+        {scratch_path: output_path},
+        video_processor.change_quality, video.path, scratch_path, quality, hw=celery_app.conf.hwaccel
+    )[output_path]
+    
+    with SessionLocal() as db:
         # Create new video record for quality version
-        duration = video_processor.get_video_duration(output_path)
-        size = video_processor.get_video_size(output_path)
-        
         new_video = crud.create_video(
             db, 
+            commit=False,
             filename=output_filename,
             original_filename=f"{quality}_{video.original_filename}",
-            duration=duration,
-            size=size,
+            **metadata,
             path=output_path,
             parent_id=video.id,
             quality=quality
         )
         
-        # Update job status
-        crud.update_job_status(db, job_id, "completed", {"new_video_id": new_video.id})
-    except Exception as e:
-        crud.update_job_status(db, job_id, "failed", {"error": str(e)})
-    finally:
-        db.close()
+        # Update job status and commit it together with the new video record
+        crud.update_job_status(db, job_id, "completed", {"new_video_id": new_video.id}, commit=False)
+        db.commit()
 
-@celery_app.task
-def process_b_roll_overlay(base_video_path, b_roll_path, output_path, position, start_time, end_time, job_id):
+@celery_app.task(base=VideoTask, bind=True)
+def process_quality_batch(self, video_id, qualities, job_ids):
+    """Process several quality changes of one video with a single decode"""
+    with SessionLocal() as db:
+        # Get original video
+        video = crud.get_video(db, video_id)
+        
+        # Create output filenames, one per requested quality
+        filenames = {
+            quality: QUALITY_TEMPLATE.format_map({"q": quality, "id": video.id, "tok": _output_token()})
+            for quality in qualities
+        }
+        scratch_outputs = {quality: str(SCRATCH_DIR / name) for quality, name in filenames.items()}
+        for job_id in job_ids:
+            crud.update_job_status(db, job_id, "processing")
+    
+    # Change quality for all outputs in one ffmpeg pass into scratch space
+    outputs = {quality: str(VIDEOS_DIR / name) for quality, name in filenames.items()}
+    probed = _publish(
+        {scratch_outputs[q]: outputs[q] for q in qualities},
+        video_processor.change_quality_batch, video.path, scratch_outputs, hw=celery_app.conf.hwaccel
+    )
+    
+    with SessionLocal() as db:
+        # Create a new video record per quality and complete its job
+        for quality, job_id in zip(qualities, job_ids):
+            output_path = outputs[quality]
+            metadata = probed[output_path]
+            
+            new_video = crud.create_video(
+                db, 
+                commit=False,
+                filename=os.path.basename(output_path),
+                original_filename=f"{quality}_{video.original_filename}",
+                **metadata,
+                path=output_path,
+                parent_id=video.id,
+                quality=quality
+            )
+            crud.update_job_status(db, job_id, "completed", {"new_video_id": new_video.id}, commit=False)
+        db.commit()
+
+@celery_app.task(base=VideoTask, bind=True)
+def process_b_roll_overlay(self, base_video_path, b_roll_path, output_path, position, start_time, end_time, job_id):
     """Process B-roll overlay"""
-    db = SessionLocal()
-    try:
+    with SessionLocal() as db:
+        # Get base video ID from job
+        base_video_id = crud.get_job(db, job_id).video_id
         crud.update_job_status(db, job_id, "processing")
-        # Add B-roll overlay
-        video_processor.add_b_roll_overlay(
-            base_video_path, b_roll_path, output_path, 
-            position, start_time, end_time
-        )
-        
+    
+    # Add B-roll overlay
+    video_processor.add_b_roll_overlay(
+        base_video_path, b_roll_path, output_path, 
+        position, start_time, end_time, hw=celery_app.conf.hwaccel
+    )
+    metadata = video_processor.probe_video(output_path)
+    
+    with SessionLocal() as db:
         # Create new video record
-        duration = video_processor.get_video_duration(output_path)
-        size = video_processor.get_video_size(output_path)
-        
-        # Get base video ID from job
-        job = crud.get_job(db, job_id)
-        base_video_id = job.video_id
-        
         new_video = crud.create_video(
-            db, 
+            db,
+            commit=False,
             filename=os.path.basename(output_path),
             original_filename=f"with_broll_{os.path.basename(base_video_path)}",
-            duration=duration,
-            size=size,
+            **metadata,
             path=output_path,
             is_processed=True,
             parent_id=base_video_id
         )
         
-        # Update job status
-        crud.update_job_status(db, job_id, "completed", {"new_video_id": new_video.id})
-    except Exception as e:
-        crud.update_job_status(db, job_id, "failed", {"error": str(e)})
-    finally:
-        db.close()
+        # Update job status and commit it together with the new video record
+        crud.update_job_status(db, job_id, "completed", {"new_video_id": new_video.id}, commit=False)
+        db.commit()
 
-@celery_app.task
-def process_image_overlay(base_video_path, image_path, output_path, position, start_time, end_time, job_id):
+@celery_app.task(base=VideoTask, bind=True)
+def process_image_overlay(self, base_video_path, image_path, output_path, position, start_time, end_time, job_id):
     """Process image overlay"""
-    db = SessionLocal()
-    try:
+    with SessionLocal() as db:
+        # Get base video ID from job
+        base_video_id = crud.get_job(db, job_id).video_id
         crud.update_job_status(db, job_id, "processing")
-        # Add image overlay
-        video_processor.add_image_overlay(
-            base_video_path, image_path, output_path, 
-            position, start_time, end_time
-        )
-        
+    
+    # Add image overlay
+    video_processor.add_image_overlay(
+        base_video_path, image_path, output_path, 
+        position, start_time, end_time, hw=celery_app.conf.hwaccel
+    )
+    metadata = video_processor.probe_video(output_path)
+    
+    with SessionLocal() as db:
         # Create new video record
-        duration = video_processor.get_video_duration(output_path)
-        size = video_processor.get_video_size(output_path)
-        
-        # Get base video ID from job
-        job = crud.get_job(db, job_id)
-        base_video_id = job.video_id
-        
         new_video = crud.create_video(
-            db, 
+            db,
+            commit=False,
             filename=os.path.basename(output_path),
             original_filename=f"with_image_{os.path.basename(base_video_path)}",
-            duration=duration,
-            size=size,
+            **metadata,
             path=output_path,
             is_processed=True,
             parent_id=base_video_id
         )
         
-        # Update job status
-        crud.update_job_status(db, job_id, "completed", {"new_video_id": new_video.id})
-    except Exception as e:
-        crud.update_job_status(db, job_id, "failed", {"error": str(e)})
-    finally:
-        db.close()   
+        # Update job status and commit it together with the new video record
+        crud.update_job_status(db, job_id, "completed", {"new_video_id": new_video.id}, commit=False)
+        db.commit()
 
-@celery_app.task
-def process_watermark(base_video_path, watermark_path, output_path, position, job_id):
+@celery_app.task(base=VideoTask, bind=True)
+def process_watermark(self, base_video_path, watermark_path, output_path, position, job_id):
     """Process adding an image watermark to a video"""
-    db = SessionLocal()
-    try:
+    with SessionLocal() as db:
+        # Get base video ID from job
+        base_video_id = crud.get_job(db, job_id).video_id
         crud.update_job_status(db, job_id, "processing")
-        # Add watermark
-        video_processor.add_watermark(
-            base_video_path, output_path, watermark_path, position
-        )
-        
+    
+    # Add watermark
+    video_processor.add_watermark(
+        base_video_path, output_path, watermark_path, position, hw=celery_app.conf.hwaccel
+    )
+    metadata = video_processor.probe_video(output_path)
+    
+    with SessionLocal() as db:
         # Create new video record
-        duration = video_processor.get_video_duration(output_path)
-        size = video_processor.get_video_size(output_path)
+        new_video = crud.create_video(
+            db,
+            commit=False,
+            filename=os.path.basename(output_path),
+            original_filename=f"with_watermark_{os.path.basename(base_video_path)}",
+            **metadata,
+            path=output_path,
+            is_processed=True,
+            parent_id=base_video_id
+        )
         
+        # Update job status and commit it together with the new video record
+        crud.update_job_status(db, job_id, "completed", {"new_video_id": new_video.id}, commit=False)
+        db.commit()
+
+@celery_app.task(base=VideoTask, bind=True)
+def process_compose_overlays(self, base_video_path, overlays, output_path, job_id):
+    """Process several overlays of one video in a single ffmpeg pass"""
+    with SessionLocal() as db:
         # Get base video ID from job
-        job = crud.get_job(db, job_id)
-        base_video_id = job.video_id
-        
+        base_video_id = crud.get_job(db, job_id).video_id
+        crud.update_job_status(db, job_id, "processing")
+    
+    # Compose overlays
+    video_processor.compose_overlays(
+        base_video_path, overlays, output_path, hw=celery_app.conf.hwaccel
+    )
+    metadata = video_processor.probe_video(output_path)
+    
+    with SessionLocal() as db:
+        # Create new video record
         new_video = crud.create_video(
             db,
+            commit=False,
             filename=os.path.basename(output_path),
-            original_filename=f"with_watermark_{os.path.basename(base_video_path)}",
-            duration=duration,
-            size=size,
+            original_filename=f"with_overlays_{os.path.basename(base_video_path)}",
+            **metadata,
             path=output_path,
             is_processed=True,
             parent_id=base_video_id
         )
         
-        # Update job status
-        crud.update_job_status(db, job_id, "completed", {"new_video_id": new_video.id})
-    except Exception as e:
-        crud.update_job_status(db, job_id, "failed", {"error": str(e)})
-    finally:
-        db.close()
+        # Update job status and commit it together with the new video record
+        crud.update_job_status(db, job_id, "completed", {"new_video_id": new_video.id}, commit=False)
+        db.commit()
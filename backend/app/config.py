@@ -1,18 +1,56 @@
 from pathlib import Path
 import os
+import tempfile
 
-try:
-    # Load environment variables from backend/.env
-    from dotenv import load_dotenv
-    env_path = Path(__file__).resolve().parent.parent / ".env"
-    load_dotenv(env_path, override=True)
-except Exception:
-    # dotenv is optional in runtime; if not installed, assume env vars are already present
-    pass
+# Load environment variables from backend/.env, unless the environment is already configured
+# (e.g. in containers or worker processes that inherit it)
+if not os.getenv("DATABASE_URL"):
+    try:
+        from dotenv import load_dotenv
+        env_path = Path(__file__).resolve().parent.parent / ".env"
+        load_dotenv(env_path, override=True)
+    except Exception:
+        # dotenv is optional in runtime; if not installed, assume env vars are already present
+        pass
 
 # Database URL (Neon/PostgreSQL or fallback to SQLite for local dev)
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
 
+# Connection pool sizing for PostgreSQL; sized for several Celery processes plus the API
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "40"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds
+
+# Create missing tables when the API starts; turn off in production and let Alembic own the schema
+AUTO_CREATE_TABLES = os.getenv("AUTO_CREATE_TABLES", "1").lower() in ("1", "true", "yes")
+
+# Directory where uploaded and processed videos are stored (relative to backend/ by default)
+VIDEOS_DIR = Path(os.getenv("VIDEOS_DIR", "static/videos"))
+
+# Scratch space for trim/quality outputs in progress (tmpfs when available); finished files are moved into VIDEOS_DIR
+SCRATCH_DIR = Path(os.getenv("SCRATCH_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()))
+
 # Redis URL for Celery broker/result backend (can be customized via .env)
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
+# Celery worker tuning for long-running ffmpeg tasks (one reserved task per process by default)
+CELERY_PREFETCH_MULTIPLIER = int(os.getenv("CELERY_PREFETCH_MULTIPLIER", "1"))
+CELERY_MAX_TASKS_PER_CHILD = int(os.getenv("CELERY_MAX_TASKS_PER_CHILD", "50"))
+
+
+# Hardware-accelerated encoding (NVIDIA NVENC/NVDEC). Workers probe the encoder at startup and
+# fall back to libx264 when it cannot be opened, so leaving this on is safe on CPU-only hosts.
+USE_HWACCEL = os.getenv("USE_HWACCEL", "1").lower() in ("1", "true", "yes")
+HWACCEL_DEVICE = os.getenv("HWACCEL_DEVICE", "cuda")
+NVENC_PRESET = os.getenv("NVENC_PRESET", "p4")
+NVENC_TUNE = os.getenv("NVENC_TUNE", "ll")
+NVENC_RC = os.getenv("NVENC_RC", "vbr")
+NVENC_CQ = int(os.getenv("NVENC_CQ", "23"))
+
+# libx264 preset for software encodes (veryfast is several times faster than x264's default medium)
+X264_PRESET = os.getenv("X264_PRESET", "veryfast")
+
+# ffmpeg threading for software encodes and filtergraphs. FFMPEG_THREADS=0 lets each encoder use every core;
+# when set, workers run cpu_count // FFMPEG_THREADS tasks at once so parallel encodes don't oversubscribe the host
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", "0"))
+FFMPEG_FILTER_THREADS = int(os.getenv("FFMPEG_FILTER_THREADS", str(FFMPEG_THREADS or os.cpu_count() or 1)))
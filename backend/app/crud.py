@@ -1,48 +1,104 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import select, insert, update, cast, func, literal, JSON
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import Session, load_only
+from sqlalchemy.ext.asyncio import AsyncSession
 import datetime
 from .database import Video, Job
 
 def get_job(db: Session, job_id: int):
-    """Fetch a Job by its primary key ID."""
-    return db.query(Job).filter(Job.id == job_id).first()
+    """Fetch a Job by its primary key ID (only the columns tasks read)."""
+    stmt = (
+        select(Job)
+        .options(load_only(Job.id, Job.video_id, Job.parameters, Job.status))
+        .where(Job.id == job_id)
+    )
+    return db.scalar(stmt)
+
+def _select_video(video_id: int):
+    return (
+        select(Video)
+        .options(load_only(Video.id, Video.path, Video.original_filename, Video.quality))
+        .where(Video.id == video_id)
+    )
 
 def get_video(db: Session, video_id: int):
-    return db.query(Video).filter(Video.id == video_id).first()
+    """Fetch a Video by ID, loading only the columns processing and downloads need."""
+    return db.scalar(_select_video(video_id))
+
+async def aget_video(db: AsyncSession, video_id: int):
+    """Async variant of get_video."""
+    return await db.scalar(_select_video(video_id))
 
-def get_videos(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(Video).offset(skip).limit(limit).all()
+def _select_videos(after_id: int = None, limit: int = 100):
+    # Keyset pagination, newest first: the primary key index seeks straight to the page instead of skipping rows
+    stmt = select(Video).order_by(Video.id.desc()).limit(limit)
+    if after_id is not None:
+        stmt = stmt.where(Video.id < after_id)
+    return stmt
 
-def create_video(db: Session, **video_fields):
-    db_video = Video(**video_fields)
-    db.add(db_video)
-    db.commit()
-    db.refresh(db_video)
+async def aget_videos(db: AsyncSession, after_id: int = None, limit: int = 100):
+    result = await db.scalars(_select_videos(after_id, limit))
+    return result.all()
+
+def create_video(db: Session, commit: bool = True, **video_fields):
+    # INSERT ... RETURNING gives back the stored row (ID and defaults) without a refresh SELECT;
+    # with commit=False the caller commits the unit of work
+    stmt = insert(Video).values(**video_fields).returning(Video)
+    db_video = db.scalars(stmt).one()
+    if commit:
+        db.commit()
     return db_video
 
-def update_video_metadata(db: Session, video_id: int, duration: float, size: int):
+async def acreate_video(db: AsyncSession, commit: bool = True, **video_fields):
+    """Async variant of create_video."""
+    result = await db.scalars(insert(Video).values(**video_fields).returning(Video))
+    db_video = result.one()
+    if commit:
+        await db.commit()
+    return db_video
+
+def update_video_metadata(db: Session, video_id: int, duration: float, size: int, width: int = None,
+                          height: int = None, video_codec: str = None, commit: bool = True):
     db_video = db.query(Video).filter(Video.id == video_id).first()
     if db_video:
         db_video.duration = duration
         db_video.size = size
+        db_video.width = width
+        db_video.height = height
+        db_video.video_codec = video_codec
         db_video.is_processed = True
-        db.commit()
-        db.refresh(db_video)
+        if commit:
+            db.commit()
+            db.refresh(db_video)
     return db_video
 
-def get_job_by_job_id(db: Session, job_id: str):
-    return db.query(Job).filter(Job.job_id == job_id).first()
+async def aget_job_by_job_id(db: AsyncSession, job_id: str):
+    return await db.scalar(select(Job).where(Job.job_id == job_id).limit(1))
 
-def create_job(db: Session, **job_fields):
+async def acreate_job(db: AsyncSession, **job_fields):
     # Ensure parameters is a dict, not None
     if "parameters" not in job_fields or job_fields["parameters"] is None:
         job_fields["parameters"] = {}
     db_job = Job(**job_fields)
     db.add(db_job)
-    db.commit()
-    db.refresh(db_job)
+    await db.commit()
+    await db.refresh(db_job)
     return db_job
 
-def update_job_status(db: Session, job_id: int, status: str, result: dict = None):
+async def acreate_video_and_job(db: AsyncSession, video_fields: dict, job_fields: dict):
+    # One transaction for both rows: the video INSERT ... RETURNING supplies the ID the job
+    # references, and a single commit flushes the job; column defaults are already loaded, so no refresh
+    db_video = await acreate_video(db, commit=False, **video_fields)
+    if job_fields.get("parameters") is None:
+        job_fields["parameters"] = {}
+    db_job = Job(video_id=db_video.id, **job_fields)
+    db.add(db_job)
+    await db.commit()
+    return db_video, db_job
+
+def update_job_status(db: Session, job_id: int, status: str, result: dict = None, commit: bool = True):
+    if db.get_bind().dialect.name == "postgresql":
+        return _update_job_status_pg(db, job_id, status, result, commit)
     db_job = db.query(Job).filter(Job.id == job_id).first()
     if db_job:
         db_job.status = status
@@ -51,6 +107,22 @@ def update_job_status(db: Session, job_id: int, status: str, result: dict = None
         if result:
             existing = db_job.parameters or {}
             db_job.parameters = {**existing, **result}
+        if commit:
+            db.commit()
+            db.refresh(db_job)
+    return db_job
+
+def _update_job_status_pg(db: Session, job_id: int, status: str, result: dict = None, commit: bool = True):
+    """PostgreSQL variant of update_job_status: one UPDATE ... RETURNING, merging parameters server-side"""
+    values = {"status": status}
+    if status == "completed":
+        values["completed_at"] = datetime.datetime.utcnow()
+    if result:
+        # jsonb || merges the result into the stored parameters without reading them back first
+        existing = func.coalesce(cast(Job.parameters, JSONB), cast("{}", JSONB))
+        values["parameters"] = cast(existing.op("||")(cast(literal(result, JSONB), JSONB)), JSON)
+    stmt = update(Job).where(Job.id == job_id).values(**values).returning(Job)
+    db_job = db.scalars(stmt).one_or_none()
+    if commit:
         db.commit()
-        db.refresh(db_job)
-    return db_job
\ No newline at end of file
+    return db_job
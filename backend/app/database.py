@@ -2,20 +2,56 @@ from sqlalchemy import Column, Integer, String, DateTime, Float, ForeignKey, Boo
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.engine import make_url
 import datetime
-from .config import DATABASE_URL
+from .config import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE
 
 # SQLAlchemy base and engine/session setup
 Base = declarative_base()
 
 # Create engine from DATABASE_URL (supports Neon/PostgreSQL). For SQLite, add thread arg.
 engine_kwargs = {}
-if DATABASE_URL.startswith("sqlite"):
+pool_kwargs = {}
+url = make_url(DATABASE_URL)
+if url.get_backend_name() == "sqlite":
     engine_kwargs["connect_args"] = {"check_same_thread": False}
-engine = create_engine(DATABASE_URL, pool_pre_ping=True, **engine_kwargs)
+elif url.get_backend_name() == "postgresql":
+    # Larger LIFO pool so concurrent workers don't queue for connections and idle ones can be recycled;
+    # a bigger compiled-statement cache keeps the CRUD queries from being recompiled
+    pool_kwargs.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_use_lifo=True,
+        query_cache_size=1200
+    )
+    if url.get_driver_name() == "psycopg2":
+        # Batch executemany INSERT/UPDATE statements into fewer round-trips
+        engine_kwargs["executemany_mode"] = "values_plus_batch"
+engine = create_engine(DATABASE_URL, pool_pre_ping=True, **pool_kwargs, **engine_kwargs)
 
-# Session factory
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def _async_url(url):
+    """Point a sync DATABASE_URL at the matching asyncio driver, plus any connect args it needs"""
+    if url.get_backend_name() == "sqlite":
+        return url.set(drivername="sqlite+aiosqlite"), {}
+    if url.get_backend_name() == "postgresql":
+        # asyncpg takes the libpq sslmode values through its ssl argument and has no channel_binding
+        query = dict(url.query)
+        sslmode = query.pop("sslmode", None)
+        query.pop("channel_binding", None)
+        connect_args = {"ssl": sslmode} if sslmode else {}
+        return url.set(drivername="postgresql+asyncpg", query=query), connect_args
+    return url, {}
+
+# Async engine for the API's handlers; Celery tasks use the sync engine
+async_url, async_connect_args = _async_url(url)
+async_engine = create_async_engine(async_url, pool_pre_ping=True, connect_args=async_connect_args, **pool_kwargs)
+
+# Session factory; objects stay loaded after commit so rows returned by crud can be read without a re-SELECT
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 class Video(Base):
     __tablename__ = "videos"
@@ -25,24 +61,28 @@ class Video(Base):
     original_filename = Column(String)
     duration = Column(Float)  # in seconds
     size = Column(Integer)    # in bytes
+    width = Column(Integer, nullable=True)   # first video stream, in pixels
+    height = Column(Integer, nullable=True)
+    video_codec = Column(String, nullable=True)  # e.g. h264
     upload_time = Column(DateTime, default=datetime.datetime.utcnow)
     path = Column(String)     # storage path
     is_processed = Column(Boolean, default=False)
     quality = Column(String, default="original")  # original, 1080p, 720p, 480p
-    parent_id = Column(Integer, ForeignKey("videos.id"), nullable=True)
+    parent_id = Column(Integer, ForeignKey("videos.id"), nullable=True, index=True)
     
     # Relationship to parent video (for trimmed versions)
-    parent = relationship("Video", remote_side=[id])
+    # lazy="raise": relationships are never loaded implicitly, so accidental N+1 queries fail loudly
+    parent = relationship("Video", remote_side=[id], lazy="raise")
     
     # Relationship to processing jobs
-    jobs = relationship("Job", back_populates="video")
+    jobs = relationship("Job", back_populates="video", lazy="raise")
 
 class Job(Base):
     __tablename__ = "jobs"
     
     id = Column(Integer, primary_key=True, index=True)
     job_id = Column(String, unique=True, index=True)
-    video_id = Column(Integer, ForeignKey("videos.id"))
+    video_id = Column(Integer, ForeignKey("videos.id"), index=True)
     type = Column(String)  # upload, trim, overlay, watermark, quality
     status = Column(String, default="pending")  # pending, processing, completed, failed
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
@@ -57,7 +97,7 @@ class Job(Base):
 #     __tablename__ = "overlays"
 #     
 #     id = Column(Integer, primary_key=True, index=True)
-#     video_id = Column(Integer, ForeignKey("videos.id"))
+#     video_id = Column(Integer, ForeignKey("videos.id"), index=True)
 #     type = Column(String)  # text, image, video
 #     content = Column(String)  # text content or file path
 #     position = Column(String)  # top-left, top-right, center, etc.
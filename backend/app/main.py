@@ -1,58 +1,106 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
-from typing import List
+from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Header, Query
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from typing import List, Optional
 import uuid
+import secrets
 import os
 import shutil
 from pathlib import Path
+import aiofiles
 
-from .database import SessionLocal, engine, Base
+from .config import VIDEOS_DIR, AUTO_CREATE_TABLES
+from .database import AsyncSessionLocal, async_engine, Base
 from . import crud, schemas, video_processor
-from .celery_worker import process_video_upload, process_video_trim, process_quality_change, process_b_roll_overlay, process_image_overlay, process_watermark
-
-# Create database tables
-Base.metadata.create_all(bind=engine)
+from .celery_worker import process_video_upload, process_video_trim, process_quality_change, process_quality_batch, process_b_roll_overlay, process_image_overlay, process_compose_overlays, process_watermark
 
 app = FastAPI(title="Video Processing API", version="1.0.0")
 
+@app.on_event("startup")
+async def init_db():
+    """Create missing tables on startup unless the schema is managed by Alembic"""
+    if AUTO_CREATE_TABLES:
+        async with async_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
 # Create static directories if they don't exist
-Path("static/videos").mkdir(parents=True, exist_ok=True)
+VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
 Path("static/watermarks").mkdir(parents=True, exist_ok=True)
 Path("static/assets/base_videos").mkdir(parents=True, exist_ok=True)
 Path("static/assets/overlay_videos").mkdir(parents=True, exist_ok=True)
 Path("static/assets/overlay_images").mkdir(parents=True, exist_ok=True)
 
+# Uploads are copied to disk in chunks of this size, so memory use does not grow with file size
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+class VideoFileResponse(FileResponse):
+    """FileResponse that streams videos in 1 MiB reads instead of Starlette's 64 KiB"""
+    chunk_size = UPLOAD_CHUNK_SIZE
+
+def parse_byte_range(range_header: str, size: int):
+    """Parse a single-range "bytes=" header into an inclusive (start, end) span; None means serve the whole file"""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        # Other units and multi-range requests may be ignored (RFC 9110), answering with the full file
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # Suffix range: the last N bytes
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if end < start and first and last:
+        return None
+    if start >= size or end < 0:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+async def read_chunks(path: str, start: int, length: int):
+    """Yield length bytes of a file from start, one chunk at a time"""
+    async with aiofiles.open(path, "rb") as f:
+        await f.seek(start)
+        while length > 0:
+            chunk = await f.read(min(UPLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+async def save_upload(upload: UploadFile, path: str):
+    """Stream an uploaded file to disk chunk by chunk"""
+    async with aiofiles.open(path, "wb") as f:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            await f.write(chunk)
+
 @app.post("/upload", response_model=schemas.Job)
 async def upload_video(file: UploadFile = File(...)):
     """Upload a video file"""
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
         # Generate unique filename
         file_extension = os.path.splitext(file.filename)[1]
-        filename = f"{uuid.uuid4().hex}{file_extension}"
-        file_path = os.path.join("static", "videos", filename)
+        filename = f"{secrets.token_urlsafe(16)}{file_extension}"
+        file_path = str(VIDEOS_DIR / filename)
         
         # Save file
-        with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+        await save_upload(file, file_path)
         
-        # Create video record
-        video = crud.create_video(
-            db, 
-            filename=filename,
-            original_filename=file.filename,
-            duration=0,  # Will be updated by celery task
-            size=0,      # Will be updated by celery task
-            path=file_path
-        )
-        
-        # Create job record
-        job = crud.create_job(
+        # Create video and job records in one commit
+        video, job = await crud.acreate_video_and_job(
             db,
-            job_id=str(uuid.uuid4()),
-            video_id=video.id,
-            type="upload"
+            dict(
+                filename=filename,
+                original_filename=file.filename,
+                duration=0,  # Will be updated by celery task
+                size=0,      # Will be updated by celery task
+                path=file_path
+            ),
+            dict(job_id=str(uuid.uuid4()), type="upload")
         )
         
         # Process video metadata asynchronously
@@ -65,7 +113,7 @@ async def upload_video(file: UploadFile = File(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        db.close()
+        await db.close()
 
 @app.post("/upload/base-video")
 async def upload_base_video():
@@ -76,23 +124,22 @@ async def upload_base_video():
         raise HTTPException(status_code=404, detail="Base video not found")
     
     # Copy to uploads directory
-    filename = f"base_{uuid.uuid4().hex}.mp4"
-    file_path = os.path.join("static", "videos", filename)
+    filename = f"base_{secrets.token_urlsafe(16)}.mp4"
+    file_path = str(VIDEOS_DIR / filename)
     
-    shutil.copy(base_video_path, file_path)
+    # copyfile takes CPython's zero-copy path (os.sendfile on Linux); run it off the event loop
+    await run_in_threadpool(shutil.copyfile, base_video_path, file_path)
     
     # Create video record
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
-        duration = video_processor.get_video_duration(file_path)
-        size = video_processor.get_video_size(file_path)
+        metadata = await video_processor.aprobe_video(file_path)
         
-        video = crud.create_video(
+        video = await crud.acreate_video(
             db, 
             filename=filename,
             original_filename="A-roll.mp4",
-            duration=duration,
-            size=size,
+            **metadata,
             path=file_path,
             is_processed=True
         )
@@ -103,42 +150,41 @@ async def upload_base_video():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        db.close()
+        await db.close()
 
-@app.get("/videos", response_model=List[schemas.Video])
-def list_videos(skip: int = 0, limit: int = 100):
-    """List all uploaded videos"""
-    db = SessionLocal()
-    try:
-        videos = crud.get_videos(db, skip=skip, limit=limit)
-        return videos
-    finally:
-        db.close()
+@app.get("/videos", response_model=schemas.VideoPage)
+async def list_videos(after_id: Optional[int] = None, limit: int = Query(100, ge=1, le=1000)):
+    """List uploaded videos, newest first; pass next_cursor back as after_id for the next page"""
+    async with AsyncSessionLocal() as db:
+        videos = await crud.aget_videos(db, after_id=after_id, limit=limit)
+    next_cursor = videos[-1].id if videos and len(videos) == limit else None
+    return {"items": videos, "next_cursor": next_cursor}
 
 @app.post("/trim", response_model=schemas.Job)
-def trim_video(request: schemas.TrimRequest):
+async def trim_video(request: schemas.TrimRequest):
     """Trim a video"""
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
         # Check if video exists
-        video = crud.get_video(db, request.video_id)
+        video = await crud.aget_video(db, request.video_id)
         if not video:
             raise HTTPException(status_code=404, detail="Video not found")
         
         # Create job record
-        job = crud.create_job(
+        job = await crud.acreate_job(
             db,
             job_id=str(uuid.uuid4()),
             video_id=video.id,
             type="trim",
             parameters={
                 "start_time": request.start_time,
-                "end_time": request.end_time
+                "end_time": request.end_time,
+                "accurate": request.accurate
             }
         )
         
         # Process trimming asynchronously
-        process_video_trim.delay(video.id, request.start_time, request.end_time, job.id)
+        process_video_trim.delay(video.id, request.start_time, request.end_time, job.id, request.accurate)
         
         return job
     except HTTPException as e:
@@ -146,24 +192,24 @@ def trim_video(request: schemas.TrimRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        db.close()
+        await db.close()
 
 @app.post("/quality", response_model=schemas.Job)
-def change_quality(request: schemas.QualityRequest):
+async def change_quality(request: schemas.QualityRequest):
     """Change video quality"""
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
         # Check if video exists
-        video = crud.get_video(db, request.video_id)
+        video = await crud.aget_video(db, request.video_id)
         if not video:
             raise HTTPException(status_code=404, detail="Video not found")
         
         # Validate quality parameter
-        if request.quality not in ["1080p", "720p", "480p"]:
+        if request.quality not in video_processor.QUALITIES:
             raise HTTPException(status_code=400, detail="Invalid quality parameter")
         
         # Create job record
-        job = crud.create_job(
+        job = await crud.acreate_job(
             db,
             job_id=str(uuid.uuid4()),
             video_id=video.id,
@@ -182,7 +228,61 @@ def change_quality(request: schemas.QualityRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        db.close()
+        await db.close()
+
+@app.post("/quality/batch", response_model=List[schemas.Job])
+async def change_quality_batch(request: schemas.QualityBatchRequest):
+    """Render several qualities of a video from a single decode"""
+    db = AsyncSessionLocal()
+    try:
+        # Check if video exists
+        video = await crud.aget_video(db, request.video_id)
+        if not video:
+            raise HTTPException(status_code=404, detail="Video not found")
+        
+        # Validate quality parameters, ignoring duplicates
+        qualities = list(dict.fromkeys(request.qualities))
+        if not qualities or not video_processor.QUALITIES.issuperset(qualities):
+            raise HTTPException(status_code=400, detail="Invalid quality parameter")
+        
+        # Create one job record per quality so each can be tracked via /status
+        jobs = [
+            await crud.acreate_job(
+                db,
+                job_id=str(uuid.uuid4()),
+                video_id=video.id,
+                type="quality",
+                parameters={
+                    "quality": quality
+                }
+            )
+            for quality in qualities
+        ]
+        
+        # Process all qualities in one task
+        process_quality_batch.delay(video.id, qualities, [job.id for job in jobs])
+        
+        return jobs
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        await db.close()
+
+def b_roll_asset(b_roll_name):
+    """Path of a provided B-roll video, or 404 if it is missing"""
+    b_roll_path = f"static/assets/overlay_videos/{b_roll_name}.mp4"
+    if not os.path.exists(b_roll_path):
+        raise HTTPException(status_code=404, detail="B-roll video not found")
+    return b_roll_path
+
+def image_overlay_asset():
+    """Path of the provided overlay image, or 404 if it is missing"""
+    image_path = "static/assets/overlay_images/image overlay.png"
+    if not os.path.exists(image_path):
+        raise HTTPException(status_code=404, detail="Image overlay not found")
+    return image_path
 
 @app.post("/overlay/b-roll/{video_id}")
 async def add_b_roll_overlay_endpoint(
@@ -193,24 +293,22 @@ async def add_b_roll_overlay_endpoint(
     end_time: float = None
 ):
     """Add a B-roll video overlay using provided assets"""
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
         # Get base video
-        base_video = crud.get_video(db, video_id)
+        base_video = await crud.aget_video(db, video_id)
         if not base_video:
             raise HTTPException(status_code=404, detail="Base video not found")
         
         # Determine B-roll path
-        b_roll_path = f"static/assets/overlay_videos/{b_roll_name}.mp4"
-        if not os.path.exists(b_roll_path):
-            raise HTTPException(status_code=404, detail="B-roll video not found")
+        b_roll_path = b_roll_asset(b_roll_name)
         
         # Create output filename
-        output_filename = f"with_{b_roll_name}_{uuid.uuid4().hex}.mp4"
-        output_path = os.path.join("static", "videos", output_filename)
+        output_filename = f"with_{b_roll_name}_{secrets.token_urlsafe(16)}.mp4"
+        output_path = str(VIDEOS_DIR / output_filename)
         
         # Create job record
-        job = crud.create_job(
+        job = await crud.acreate_job(
             db,
             job_id=str(uuid.uuid4()),
             video_id=video_id,
@@ -240,7 +338,7 @@ async def add_b_roll_overlay_endpoint(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        db.close()
+        await db.close()
 
 @app.post("/overlay/image/{video_id}")
 async def add_image_overlay_endpoint(
@@ -250,24 +348,22 @@ async def add_image_overlay_endpoint(
     end_time: float = None
 ):
     """Add image overlay using provided asset"""
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
         # Get base video
-        base_video = crud.get_video(db, video_id)
+        base_video = await crud.aget_video(db, video_id)
         if not base_video:
             raise HTTPException(status_code=404, detail="Base video not found")
         
         # Determine image path
-        image_path = "static/assets/overlay_images/image overlay.png"
-        if not os.path.exists(image_path):
-            raise HTTPException(status_code=404, detail="Image overlay not found")
+        image_path = image_overlay_asset()
         
         # Create output filename
-        output_filename = f"with_image_overlay_{uuid.uuid4().hex}.mp4"
-        output_path = os.path.join("static", "videos", output_filename)
+        output_filename = f"with_image_overlay_{secrets.token_urlsafe(16)}.mp4"
+        output_path = str(VIDEOS_DIR / output_filename)
         
         # Create job record
-        job = crud.create_job(
+        job = await crud.acreate_job(
             db,
             job_id=str(uuid.uuid4()),
             video_id=video_id,
@@ -294,39 +390,52 @@ async def add_image_overlay_endpoint(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        db.close()
+        await db.close()
 
 @app.get("/status/{job_id}", response_model=schemas.Job)
-def get_job_status(job_id: str):
+async def get_job_status(job_id: str):
     """Get job status"""
-    db = SessionLocal()
-    try:
-        job = crud.get_job_by_job_id(db, job_id)
-        if not job:
-            raise HTTPException(status_code=404, detail="Job not found")
-        return job
-    finally:
-        db.close()
+    async with AsyncSessionLocal() as db:
+        job = await crud.aget_job_by_job_id(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 @app.get("/download/{video_id}")
-def download_video(video_id: int):
-    """Download a video"""
-    db = SessionLocal()
+async def download_video(video_id: int, range_header: Optional[str] = Header(None, alias="Range")):
+    """Download a video, or the byte range a seeking player asks for"""
+    async with AsyncSessionLocal() as db:
+        video = await crud.aget_video(db, video_id)
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found")
+    
+    # One stat both checks the file and gives the response its headers, so it isn't stat'ed again
     try:
-        video = crud.get_video(db, video_id)
-        if not video:
-            raise HTTPException(status_code=404, detail="Video not found")
-        
-        if not os.path.exists(video.path):
-            raise HTTPException(status_code=404, detail="Video file not found")
-        
-        return FileResponse(
+        stat_result = os.stat(video.path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Video file not found")
+    
+    headers = {"Accept-Ranges": "bytes"}
+    byte_range = parse_byte_range(range_header, stat_result.st_size) if range_header else None
+    if byte_range is None:
+        return VideoFileResponse(
             video.path, 
             media_type="video/mp4",
-            filename=video.original_filename
+            filename=video.original_filename,
+            stat_result=stat_result,
+            headers=headers
         )
-    finally:
-        db.close()
+    
+    # Partial content: only the requested span is read and sent
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        read_chunks(video.path, start, end - start + 1),
+        status_code=206,
+        media_type="video/mp4",
+        headers=headers
+    )
 
 @app.get("/available-assets")
 def get_available_assets():
@@ -341,44 +450,43 @@ def get_available_assets():
 @app.post("/demo/full-processing")
 async def demo_full_processing():
     """Demo endpoint that showcases all processing capabilities with your assets"""
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
         # Step 1: Upload base video
         base_video = await upload_base_video()
         
-        # Step 2: Add B-roll 1 overlay
-        broll1_job = await add_b_roll_overlay_endpoint(
-            base_video.id, 
-            "B-roll 1", 
-            "top-right", 
-            5,  # start at 5 seconds
-            15   # end at 15 seconds
-        )
+        overlays = [
+            # Step 2: B-roll 1 overlay, from 5 to 15 seconds
+            {"path": b_roll_asset("B-roll 1"), "position": "top-right", "start_time": 5, "end_time": 15},
+            # Step 3: B-roll 2 overlay, from 10 to 20 seconds
+            {"path": b_roll_asset("B-roll 2"), "position": "bottom-left", "start_time": 10, "end_time": 20},
+            # Step 4: Image overlay, shown throughout the video
+            {"path": image_overlay_asset(), "position": "bottom-right", "start_time": 0, "end_time": None},
+        ]
         
-        # Step 3: Add B-roll 2 overlay
-        broll2_job = await add_b_roll_overlay_endpoint(
-            base_video.id, 
-            "B-roll 2", 
-            "bottom-left", 
-            10,  # start at 10 seconds
-            20   # end at 20 seconds
-        )
+        # Create output filename
+        output_filename = f"with_overlays_{secrets.token_urlsafe(16)}.mp4"
+        output_path = str(VIDEOS_DIR / output_filename)
         
-        # Step 4: Add image overlay
-        image_job = await add_image_overlay_endpoint(
-            base_video.id,
-            "bottom-right",
-            0,   # start at beginning
-            None  # show throughout video
+        # Create job record
+        job = await crud.acreate_job(
+            db,
+            job_id=str(uuid.uuid4()),
+            video_id=base_video.id,
+            type="compose_overlays",
+            parameters={
+                "overlays": overlays
+            }
         )
         
+        # Decode the base video once, apply all overlays and encode once
+        process_compose_overlays.delay(base_video.path, overlays, output_path, job.id)
+        
         return {
             "message": "Full processing demo started",
             "base_video_id": base_video.id,
             "jobs": {
-                "broll1": broll1_job.job_id,
-                "broll2": broll2_job.job_id,
-                "image": image_job.job_id
+                "overlays": job.job_id
             }
         }
     except HTTPException as e:
@@ -386,32 +494,30 @@ async def demo_full_processing():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        db.close()
+        await db.close()
 
 @app.post("/watermark")
-def add_watermark_to_video(video_id: int, watermark_file: UploadFile = File(...), position: str = "top-right"):
+async def add_watermark_to_video(video_id: int, watermark_file: UploadFile = File(...), position: str = "top-right"):
     """Add watermark to video"""
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
         # Validate base video
-        video = crud.get_video(db, video_id)
+        video = await crud.aget_video(db, video_id)
         if not video:
             raise HTTPException(status_code=404, detail="Video not found")
 
         # Save uploaded watermark file to static/watermarks
         file_ext = os.path.splitext(watermark_file.filename)[1]
-        watermark_filename = f"watermark_{uuid.uuid4().hex}{file_ext}"
+        watermark_filename = f"watermark_{secrets.token_urlsafe(16)}{file_ext}"
         watermark_path = os.path.join("static", "watermarks", watermark_filename)
-        with open(watermark_path, "wb") as f:
-            content = watermark_file.file.read()
-            f.write(content)
+        await save_upload(watermark_file, watermark_path)
 
         # Prepare output
-        output_filename = f"with_watermark_{uuid.uuid4().hex}.mp4"
-        output_path = os.path.join("static", "videos", output_filename)
+        output_filename = f"with_watermark_{secrets.token_urlsafe(16)}.mp4"
+        output_path = str(VIDEOS_DIR / output_filename)
 
         # Create job
-        job = crud.create_job(
+        job = await crud.acreate_job(
             db,
             job_id=str(uuid.uuid4()),
             video_id=video.id,
@@ -436,7 +542,7 @@ def add_watermark_to_video(video_id: int, watermark_file: UploadFile = File(...)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        db.close()
+        await db.close()
 
 @app.post("/overlay/text")
 def add_text_overlay_to_video(video_id: int, text: str, position: str = "top-left", fontsize: int = 24):
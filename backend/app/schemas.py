@@ -7,6 +7,9 @@ class VideoBase(BaseModel):
     original_filename: str
     duration: float
     size: int
+    width: Optional[int] = None
+    height: Optional[int] = None
+    video_codec: Optional[str] = None
     upload_time: datetime
     path: str
     is_processed: bool = False
@@ -22,6 +25,10 @@ class Video(VideoBase):
     class Config:
         orm_mode = True
 
+class VideoPage(BaseModel):
+    items: List[Video]
+    next_cursor: Optional[int] = None  # pass as after_id to get the next page; None on the last page
+
 class JobBase(BaseModel):
     type: str
     status: str = "pending"
@@ -62,7 +69,12 @@ class TrimRequest(BaseModel):
     video_id: int
     start_time: float
     end_time: float
+    accurate: bool = False  # frame-exact cut (re-encodes); default cuts on keyframes
 
 class QualityRequest(BaseModel):
     video_id: int
-    quality: str  # 1080p, 720p, 480p
\ No newline at end of file
+    quality: str  # 1080p, 720p, 480p
+
+class QualityBatchRequest(BaseModel):
+    video_id: int
+    qualities: List[str]  # any of 1080p, 720p, 480p
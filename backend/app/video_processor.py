@@ -1,144 +1,305 @@
 import os
+import json
+import asyncio
+import functools
 import subprocess
 import uuid
 from pathlib import Path
+from .config import NVENC_PRESET, NVENC_TUNE, NVENC_RC, NVENC_CQ, X264_PRESET, FFMPEG_THREADS, FFMPEG_FILTER_THREADS
 
-def get_video_duration(file_path):
-    """Get video duration using ffprobe"""
+# Output qualities: target height, bitrate (NVENC target / x264 ceiling) and x264 CRF
+QUALITY_TABLE = {
+    "1080p": (1080, "4000k", 21),
+    "720p": (720, "2500k", 23),
+    "480p": (480, "1000k", 25),
+}
+QUALITIES = frozenset(QUALITY_TABLE)
+
+# Named positions as x:y expressions for the overlay filter and for drawtext; unknown names mean center
+OVERLAY_POS = {
+    "top-left": "10:10",
+    "top-right": "main_w-overlay_w-10:10",
+    "bottom-left": "10:main_h-overlay_h-10",
+    "bottom-right": "main_w-overlay_w-10:main_h-overlay_h-10",
+    "center": "(main_w-overlay_w)/2:(main_h-overlay_h)/2",
+}
+TEXT_POS = {
+    "top-left": "10:10",
+    "top-right": "w-text_w-10:10",
+    "bottom-left": "10:h-text_h-10",
+    "bottom-right": "w-text_w-10:h-text_h-10",
+    "center": "(w-text_w)/2:(h-text_h)/2",
+}
+
+@functools.lru_cache(maxsize=256)
+def _overlay_filter(position, start_time=0, end_time=None, cuda=False):
+    """Overlay filter (overlay, or overlay_cuda) placing the input at a named position, optionally only between two times"""
+    xy = OVERLAY_POS.get(position, OVERLAY_POS["center"])
+    timing = f":enable='between(t,{start_time},{end_time})'" if end_time is not None else ""
+    if cuda:
+        x, y = xy.split(":")
+        return f"overlay_cuda=x={x}:y={y}{timing}"
+    return f"overlay={xy}{timing}"
+
+def nvenc_available(device="cuda"):
+    """Check that ffmpeg can actually open an h264_nvenc session on the given device"""
+    # A one-frame test encode catches builds that list h264_nvenc but have no usable GPU/driver
+    cmd = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-init_hw_device', device,
+        '-f', 'lavfi', '-i', 'color=black:s=256x256:d=0.1', '-frames:v', '1',
+        '-c:v', 'h264_nvenc', '-f', 'null', '-'
+    ]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        return False
+    return result.returncode == 0
+
+class FFmpegError(subprocess.CalledProcessError):
+    """CalledProcessError whose message ends with the last lines ffmpeg/ffprobe wrote to stderr"""
+    def __str__(self):
+        stderr = self.stderr.decode(errors="replace") if isinstance(self.stderr, bytes) else (self.stderr or "")
+        tail = stderr.strip().splitlines()[-5:]
+        return "\n".join([super().__str__(), *tail])
+
+@functools.lru_cache(maxsize=None)
+def overlay_cuda_available(device="cuda", timed=False):
+    """Check that ffmpeg's overlay_cuda filter takes position expressions (and 'enable' when timed) on the device"""
+    # Probed once per process; builds before expression/timeline support reject these options
+    enable = ":enable='between(t,0,1)'" if timed else ""
     cmd = [
-        'ffprobe', '-v', 'error', '-show_entries', 
-        'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', file_path
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-init_hw_device', f'{device}=gpu', '-filter_hw_device', 'gpu',
+        '-f', 'lavfi', '-i', 'color=black:s=256x256:d=0.1', '-f', 'lavfi', '-i', 'color=white:s=64x64:d=0.1',
+        '-filter_complex',
+        f"[0:v]format=nv12,hwupload[m];[1:v]format=nv12,hwupload[o];[m][o]overlay_cuda=x=main_w-overlay_w-10:y=10{enable}",
+        '-frames:v', '1', '-f', 'null', '-'
     ]
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    return float(result.stdout)
+    try:
+        result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        return False
+    return result.returncode == 0
+
+def _run_ffmpeg(cmd):
+    """Run an ffmpeg command, raising FFmpegError on failure"""
+    # Only errors are logged (no banner or per-frame progress), and they are captured for the exception
+    # instead of flooding the worker log. No stdin so ffmpeg never waits on interactive input; stdout is
+    # unused since every command writes to a file
+    cmd = [cmd[0], '-hide_banner', '-nostats', '-loglevel', 'error', *cmd[1:]]
+    result = subprocess.run(
+        cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        text=True, errors="replace"
+    )
+    if result.returncode:
+        raise FFmpegError(result.returncode, cmd, stderr=result.stderr)
 
-def get_video_size(file_path):
-    """Get video file size"""
-    return os.path.getsize(file_path)
+def _decoder_args(hw=None, keep_on_device=False):
+    """Input options for hardware decoding (empty for software decoding)"""
+    if not hw:
+        return []
+    args = ['-hwaccel', hw]
+    if keep_on_device:
+        args += ['-hwaccel_output_format', hw]
+    return args
 
-def trim_video(input_path, output_path, start_time, end_time):
+def _filter_threads(option='-filter_complex_threads'):
+    """Global option sizing the thread pool of a -filter_complex (or, with '-filter_threads', a -vf) graph"""
+    return [option, str(FFMPEG_FILTER_THREADS)]
+
+def _encoder_args(hw=None):
+    """Video encoder options: NVENC when a hardware device is given, libx264 otherwise"""
+    if not hw:
+        return ['-c:v', 'libx264', '-preset', X264_PRESET, '-threads', str(FFMPEG_THREADS)]
+    return [
+        '-c:v', 'h264_nvenc', '-preset', NVENC_PRESET, '-tune', NVENC_TUNE,
+        '-rc', NVENC_RC, '-cq', str(NVENC_CQ)
+    ]
+
+def _probe_command(file_path):
+    """ffprobe command reading format and first video stream info from the container header (nothing is decoded)"""
+    return [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+        'format=duration,size:stream=codec_name,width,height', '-print_format', 'json', file_path
+    ]
+
+def _parse_probe(output, file_path):
+    """Turn ffprobe's JSON output into a dict keyed like the Video columns"""
+    info = json.loads(output)
+    fmt = info.get("format", {})
+    stream = (info.get("streams") or [{}])[0]
+    return {
+        "duration": float(fmt["duration"]),
+        "size": int(fmt["size"]) if "size" in fmt else os.stat(file_path).st_size,
+        "width": stream.get("width"),
+        "height": stream.get("height"),
+        "video_codec": stream.get("codec_name"),
+    }
+
+def probe_video(file_path):
+    """Get duration, size, dimensions and video codec with a single ffprobe call"""
+    cmd = _probe_command(file_path)
+    result = subprocess.run(
+        cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    if result.returncode:
+        raise FFmpegError(result.returncode, cmd, result.stdout, result.stderr)
+    return _parse_probe(result.stdout, file_path)
+
+async def aprobe_video(file_path):
+    """Async variant of probe_video for the API's event loop"""
+    cmd = _probe_command(file_path)
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+    except NotImplementedError:
+        # Selector event loops (e.g. uvicorn --reload on Windows) cannot spawn subprocesses
+        return await asyncio.to_thread(probe_video, file_path)
+    stdout, stderr = await proc.communicate()
+    if proc.returncode:
+        raise FFmpegError(proc.returncode, cmd, stdout, stderr)
+    return _parse_probe(stdout.decode(), file_path)
+
+def trim_video(input_path, output_path, start_time, end_time, accurate=False):
     """Trim video using ffmpeg"""
+    # -ss before -i seeks in the demuxer instead of decoding everything up to start_time;
+    # after an input seek timestamps restart at zero, so the cut length is given with -t
     cmd = [
-        'ffmpeg', '-i', input_path, '-ss', str(start_time), 
-        '-to', str(end_time), '-c', 'copy', output_path
+        'ffmpeg', '-y', '-ss', str(start_time), '-i', input_path,
+        '-t', str(end_time - start_time)
     ]
-    subprocess.run(cmd, check=True)
+    if accurate:
+        # Stream copy can only cut on keyframes; re-encoding the video makes the input seek frame-exact
+        cmd += [*_encoder_args(), '-c:a', 'copy']
+    else:
+        cmd += ['-c', 'copy', '-avoid_negative_ts', 'make_zero']
+    cmd.append(output_path)
+    _run_ffmpeg(cmd)
 
-def add_watermark(input_path, output_path, watermark_path, position="top-left"):
+def add_watermark(input_path, output_path, watermark_path, position="top-left", hw=None):
     """Add watermark to video"""
-    # Calculate position based on input
-    if position == "top-left":
-        overlay = "10:10"
-    elif position == "top-right":
-        overlay = "main_w-overlay_w-10:10"
-    elif position == "bottom-left":
-        overlay = "10:main_h-overlay_h-10"
-    elif position == "bottom-right":
-        overlay = "main_w-overlay_w-10:main_h-overlay_h-10"
-    else:  # center
-        overlay = "(main_w-overlay_w)/2:(main_h-overlay_h)/2"
+    cmd = [
+        'ffmpeg', '-y', *_filter_threads(), *_decoder_args(hw), '-i', input_path, '-i', watermark_path,
+        '-filter_complex', _overlay_filter(position), *_encoder_args(hw), '-codec:a', 'copy', output_path
+    ]
+    _run_ffmpeg(cmd)
+
+def compose_overlays(input_path, overlays, output_path, hw=None):
+    """Apply several overlays in one decode/encode pass; each overlay is a dict of path, position, start_time, end_time"""
+    # Chain one overlay filter per input: [0:v][1:v] -> [o1], [o1][2:v] -> [o2], ... -> [v]
+    inputs = []
+    graph = []
+    last = "0:v"
+    for i, overlay in enumerate(overlays, start=1):
+        inputs += ['-i', overlay["path"]]
+        label = "v" if i == len(overlays) else f"o{i}"
+        overlay_filter = _overlay_filter(overlay.get("position"), overlay.get("start_time", 0), overlay.get("end_time"))
+        graph.append(f"[{last}][{i}:v] {overlay_filter} [{label}]")
+        last = label
     
     cmd = [
-        'ffmpeg', '-i', input_path, '-i', watermark_path,
-        '-filter_complex', f'overlay={overlay}', '-codec:a', 'copy', output_path
+        'ffmpeg', '-y', *_filter_threads(), *_decoder_args(hw), '-i', input_path, *inputs,
+        '-filter_complex', "; ".join(graph),
+        '-map', '[v]', '-map', '0:a', *_encoder_args(hw), '-c:a', 'copy', output_path
     ]
-    subprocess.run(cmd, check=True)
+    _run_ffmpeg(cmd)
 
 def add_text_overlay(input_path, output_path, text, position="top-left", fontsize=24, fontcolor="white"):
     """Add text overlay to video"""
-    # Calculate position based on input
-    if position == "top-left":
-        xy = "10:10"
-    elif position == "top-right":
-        xy = "w-text_w-10:10"
-    elif position == "bottom-left":
-        xy = "10:h-text_h-10"
-    elif position == "bottom-right":
-        xy = "w-text_w-10:h-text_h-10"
-    else:  # center
-        xy = "(w-text_w)/2:(h-text_h)/2"
+    xy = TEXT_POS.get(position, TEXT_POS["center"])
     
     # Handle different Indian language fonts
     font_path = "/usr/share/fonts/truetype/freefont/FreeSans.ttf"  # Default, can be customized
     
     cmd = [
-        'ffmpeg', '-i', input_path,
+        'ffmpeg', '-y', *_filter_threads('-filter_threads'), '-i', input_path,
         '-vf', f"drawtext=text='{text}':fontfile={font_path}:fontsize={fontsize}:fontcolor={fontcolor}:x={xy}",
         '-codec:a', 'copy', output_path
     ]
-    subprocess.run(cmd, check=True)
+    _run_ffmpeg(cmd)
 
-def change_quality(input_path, output_path, quality):
-    """Change video quality"""
-    if quality == "1080p":
-        resolution = "1920x1080"
-        bitrate = "4000k"
-    elif quality == "720p":
-        resolution = "1280x720"
-        bitrate = "2500k"
-    elif quality == "480p":
-        resolution = "854x480"
-        bitrate = "1000k"
-    else:
-        resolution = "1920x1080"
-        bitrate = "4000k"
+def _rate_args(hw, bitrate, crf):
+    """Rate control for a quality: NVENC targets the bitrate, x264 encodes at constant quality capped at it"""
+    if hw:
+        return ['-b:v', bitrate]
+    return ['-crf', str(crf), '-maxrate', bitrate, '-bufsize', f"{2 * int(bitrate.rstrip('k'))}k"]
+
+def transcode_gpu(input_path, output_path, quality, device="cuda"):
+    """Change video quality in one fused GPU pass (NVDEC decode, scale_cuda, NVENC encode)"""
+    height, bitrate, _ = QUALITY_TABLE.get(quality, QUALITY_TABLE["1080p"])
     
+    # Frames stay in VRAM from decode to encode, so no host<->device copies per frame
     cmd = [
-        'ffmpeg', '-i', input_path, '-s', resolution, 
+        'ffmpeg', '-y', *_decoder_args(device, keep_on_device=True), '-i', input_path,
+        '-vf', _scale_filter(height, device), *_encoder_args(device),
         '-b:v', bitrate, '-c:a', 'copy', output_path
     ]
-    subprocess.run(cmd, check=True)
+    _run_ffmpeg(cmd)
 
-def add_b_roll_overlay(input_path, b_roll_path, output_path, position="top-right", start_time=0, end_time=None):
-    """Add B-roll video overlay with timing"""
-    # Calculate position
-    if position == "top-left":
-        overlay = "10:10"
-    elif position == "top-right":
-        overlay = "main_w-overlay_w-10:10"
-    elif position == "bottom-left":
-        overlay = "10:main_h-overlay_h-10"
-    elif position == "bottom-right":
-        overlay = "main_w-overlay_w-10:main_h-overlay_h-10"
-    else:  # center
-        overlay = "(main_w-overlay_w)/2:(main_h-overlay_h)/2"
+def _scale_filter(height, hw=None):
+    """Scale to a target height, keeping the source aspect ratio (width rounded to an even number)"""
+    if hw:
+        return f'scale_cuda=-2:{height}'
+    # fast_bilinear is much cheaper than swscale's default bicubic; explicit yuv420p keeps outputs widely playable
+    return f'scale=-2:{height}:flags=fast_bilinear,format=yuv420p'
+
+def change_quality(input_path, output_path, quality, hw=None):
+    """Change video quality"""
+    if hw:
+        return transcode_gpu(input_path, output_path, quality, device=hw)
+    
+    height, bitrate, crf = QUALITY_TABLE.get(quality, QUALITY_TABLE["1080p"])
+    cmd = [
+        'ffmpeg', '-y', *_filter_threads('-filter_threads'), '-i', input_path, '-vf', _scale_filter(height),
+        *_encoder_args(), *_rate_args(None, bitrate, crf), '-c:a', 'copy', output_path
+    ]
+    _run_ffmpeg(cmd)
+
+def change_quality_batch(input_path, outputs, hw=None):
+    """Render several qualities from one decode; outputs maps quality -> output path"""
+    qualities = list(outputs)
+    
+    # Decode once, split the stream and scale/encode each branch in the same ffmpeg process
+    graph = [f"[0:v]split={len(qualities)}" + "".join(f"[s{i}]" for i in range(len(qualities)))]
+    output_args = []
+    for i, quality in enumerate(qualities):
+        height, bitrate, crf = QUALITY_TABLE.get(quality, QUALITY_TABLE["1080p"])
+        graph.append(f"[s{i}]{_scale_filter(height, hw)}[v{i}]")
+        output_args += [
+            '-map', f'[v{i}]', '-map', '0:a?', *_encoder_args(hw),
+            *_rate_args(hw, bitrate, crf), '-c:a', 'copy', outputs[quality]
+        ]
     
-    # Add timing if specified
-    if end_time is not None:
-        filter_complex = f"[0:v][1:v] overlay={overlay}:enable='between(t,{start_time},{end_time})' [v]"
+    cmd = [
+        'ffmpeg', '-y', *_filter_threads(), *_decoder_args(hw, keep_on_device=True), '-i', input_path,
+        '-filter_complex', ";".join(graph), *output_args
+    ]
+    _run_ffmpeg(cmd)
+
+def add_b_roll_overlay(input_path, b_roll_path, output_path, position="top-right", start_time=0, end_time=None, hw=None):
+    """Add B-roll video overlay with timing"""
+    cuda = bool(hw) and overlay_cuda_available(hw, timed=end_time is not None)
+    if cuda:
+        # Both videos decode into VRAM and are composited there, so frames never leave the GPU before NVENC
+        inputs = [*_decoder_args(hw, keep_on_device=True), '-i', input_path, *_decoder_args(hw, keep_on_device=True), '-i', b_roll_path]
     else:
-        filter_complex = f"[0:v][1:v] overlay={overlay} [v]"
+        inputs = [*_decoder_args(hw), '-i', input_path, '-i', b_roll_path]
+    filter_complex = f"[0:v][1:v] {_overlay_filter(position, start_time, end_time, cuda)} [v]"
     
     cmd = [
-        'ffmpeg', '-i', input_path, '-i', b_roll_path,
+        'ffmpeg', '-y', *_filter_threads(), *inputs,
         '-filter_complex', filter_complex,
-        '-map', '[v]', '-map', '0:a', '-c:a', 'copy', output_path
+        '-map', '[v]', '-map', '0:a', *_encoder_args(hw), '-c:a', 'copy', output_path
     ]
-    subprocess.run(cmd, check=True)
+    _run_ffmpeg(cmd)
 
-def add_image_overlay(input_path, image_path, output_path, position="bottom-right", start_time=0, end_time=None):
+def add_image_overlay(input_path, image_path, output_path, position="bottom-right", start_time=0, end_time=None, hw=None):
     """Add image overlay with timing"""
-    # Calculate position
-    if position == "top-left":
-        overlay = "10:10"
-    elif position == "top-right":
-        overlay = "main_w-overlay_w-10:10"
-    elif position == "bottom-left":
-        overlay = "10:main_h-overlay_h-10"
-    elif position == "bottom-right":
-        overlay = "main_w-overlay_w-10:main_h-overlay_h-10"
-    else:  # center
-        overlay = "(main_w-overlay_w)/2:(main_h-overlay_h)/2"
-    
-    # Add timing if specified
-    if end_time is not None:
-        filter_complex = f"[0:v][1:v] overlay={overlay}:enable='between(t,{start_time},{end_time})' [v]"
-    else:
-        filter_complex = f"[0:v][1:v] overlay={overlay} [v]"
+    filter_complex = f"[0:v][1:v] {_overlay_filter(position, start_time, end_time)} [v]"
     
     cmd = [
-        'ffmpeg', '-i', input_path, '-i', image_path,
+        'ffmpeg', '-y', *_filter_threads(), *_decoder_args(hw), '-i', input_path, '-i', image_path,
         '-filter_complex', filter_complex,
-        '-map', '[v]', '-map', '0:a', '-c:a', 'copy', output_path
+        '-map', '[v]', '-map', '0:a', *_encoder_args(hw), '-c:a', 'copy', output_path
     ]
-    subprocess.run(cmd, check=True) 
+    _run_ffmpeg(cmd) 